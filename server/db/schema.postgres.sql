@@ -1,4 +1,7 @@
 -- Drop tables if they exist
+DROP TABLE IF EXISTS notification_outbox;
+DROP TABLE IF EXISTS prize_reservations;
+DROP TABLE IF EXISTS prize_stock_shards;
 DROP TABLE IF EXISTS prize_redemptions;
 DROP TABLE IF EXISTS prizes;
 DROP TABLE IF EXISTS quest_completions;
@@ -44,7 +47,26 @@ CREATE TABLE prizes (
     description TEXT,
     stars_cost INTEGER,
     image_url TEXT,
-    available BOOLEAN DEFAULT TRUE
+    available BOOLEAN DEFAULT TRUE,
+    stock INTEGER CHECK (stock >= 0)  -- NULL means unlimited
+);
+
+-- Remaining stock of limited prizes, split across shards so concurrent
+-- redemptions of one prize don't all queue on a single row
+CREATE TABLE prize_stock_shards (
+    prize_id TEXT REFERENCES prizes(id) ON DELETE CASCADE,
+    shard INTEGER,
+    remaining INTEGER NOT NULL CHECK (remaining >= 0),
+    PRIMARY KEY (prize_id, shard)
+);
+
+-- Units held for a seeker until they redeem or the hold expires
+CREATE TABLE prize_reservations (
+    id TEXT PRIMARY KEY,
+    prize_id TEXT REFERENCES prizes(id) ON DELETE CASCADE,
+    seeker_id TEXT REFERENCES seekers(id) ON DELETE CASCADE,
+    shard INTEGER NOT NULL,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
 );
 
 CREATE TABLE prize_redemptions (
@@ -68,8 +90,25 @@ CREATE TABLE quest_completions (
     CONSTRAINT fk_seeker FOREIGN KEY (seeker_id) REFERENCES seekers(id)
 );
 
+-- Transactional outbox for parent notifications, drained by the dispatcher
+CREATE TABLE notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'delivered', 'dead')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    delivered_at TIMESTAMP WITH TIME ZONE
+);
+
 -- Create indexes for better performance
 CREATE INDEX idx_quests_status ON quests(status);
 CREATE INDEX idx_quests_assigned_to ON quests(assigned_to);
 CREATE INDEX idx_quest_suggestions_status ON quest_suggestions(status);
-CREATE INDEX idx_prize_redemptions_seeker ON prize_redemptions(seeker_id); 
\ No newline at end of file
+CREATE INDEX idx_prize_redemptions_seeker ON prize_redemptions(seeker_id);
+CREATE INDEX idx_prize_reservations_expires ON prize_reservations(expires_at);
+-- One hold per seeker and prize
+CREATE UNIQUE INDEX idx_prize_reservations_seeker ON prize_reservations(prize_id, seeker_id);
+CREATE INDEX idx_notification_outbox_due ON notification_outbox(next_attempt_at) WHERE status = 'pending';
@@ -1,10 +1,16 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
 import uuid
+import asyncio
+import time
+import math
 import asyncpg
+import httpx
+import json
+import random
 from asyncpg.pool import Pool
 from dotenv import load_dotenv
 import os
@@ -30,22 +36,158 @@ app.add_middleware(
 )
 
 # Database connection
-async def get_db_pool() -> Pool:
+# Seconds a client's reads stay on the primary after it writes (read-your-writes)
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', '5'))
+# Replica replay lag (seconds) above which reads fall back to the primary
+MAX_REPLICA_LAG = float(os.getenv('MAX_REPLICA_LAG', '2'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '1'))
+
+# Limited-stock prizes
+PRIZE_STOCK_SHARDS = int(os.getenv('PRIZE_STOCK_SHARDS', '4'))
+RESERVATION_TTL = float(os.getenv('RESERVATION_TTL', '120'))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv('RESERVATION_SWEEP_INTERVAL', '10'))
+
+# Notification outbox dispatcher
+NOTIFICATION_WEBHOOK_URL = os.getenv('NOTIFICATION_WEBHOOK_URL')
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', '50'))
+NOTIFICATION_CONCURRENCY = int(os.getenv('NOTIFICATION_CONCURRENCY', '10'))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '8'))
+NOTIFICATION_BACKOFF_BASE = float(os.getenv('NOTIFICATION_BACKOFF_BASE', '2'))
+NOTIFICATION_BACKOFF_MAX = float(os.getenv('NOTIFICATION_BACKOFF_MAX', '3600'))
+NOTIFICATION_POLL_INTERVAL = float(os.getenv('NOTIFICATION_POLL_INTERVAL', '1'))
+NOTIFICATION_TIMEOUT = float(os.getenv('NOTIFICATION_TIMEOUT', '10'))
+# Delivered notifications are purged after this many seconds
+NOTIFICATION_RETENTION = float(os.getenv('NOTIFICATION_RETENTION', str(7 * 24 * 3600)))
+NOTIFICATION_PURGE_INTERVAL = float(os.getenv('NOTIFICATION_PURGE_INTERVAL', '3600'))
+
+async def get_db_pool(prefix: str = 'DB') -> Pool:
+    # Read pool settings (DB_READ_*) fall back to the primary's (DB_*)
+    def setting(name: str, default: Optional[str] = None) -> Optional[str]:
+        return os.getenv(f'{prefix}_{name}') or os.getenv(f'DB_{name}', default)
+
     return await asyncpg.create_pool(
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        database=os.getenv('DB_NAME'),
-        host=os.getenv('DB_HOST'),
-        port=os.getenv('DB_PORT', '5432')
+        user=setting('USER'),
+        password=setting('PASSWORD'),
+        database=setting('NAME'),
+        host=setting('HOST'),
+        port=setting('PORT', '5432')
     )
 
-# Initialize database pool on startup
+async def get_replica_lag(primary: Pool, replica: Pool) -> float:
+    # Read the primary's WAL position first; a replica that has replayed up
+    # to it is current. Otherwise the lag is the age of its last replayed
+    # transaction, which keeps growing if replication has stalled.
+    async with primary.acquire() as conn:
+        primary_lsn = await conn.fetchval('SELECT pg_current_wal_lsn()')
+    async with replica.acquire() as conn:
+        lag = await conn.fetchval('''
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_replay_lsn() >= $1::pg_lsn THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END
+        ''', primary_lsn)
+        # NULL means nothing has been replayed yet
+        return float('inf') if lag is None else float(lag)
+
+async def check_replica() -> bool:
+    # Connect the replica pool on demand, so a replica that was down at
+    # startup is picked up once it comes back
+    if app.state.read_pool is None:
+        app.state.read_pool = await get_db_pool('DB_READ')
+    lag = await get_replica_lag(app.state.pool, app.state.read_pool)
+    return lag <= MAX_REPLICA_LAG
+
+async def monitor_replica_lag():
+    while True:
+        try:
+            # A replica that doesn't answer in time counts as unhealthy
+            app.state.replica_healthy = await asyncio.wait_for(
+                check_replica(), REPLICA_LAG_CHECK_INTERVAL
+            )
+        except Exception as e:
+            print(f"Error checking replica lag: {str(e) or type(e).__name__}")
+            app.state.replica_healthy = False
+        await asyncio.sleep(REPLICA_LAG_CHECK_INTERVAL)
+
+# Cookie carrying the time of this client's last write, so read-your-writes
+# works per browser and across workers without server-side state
+LAST_WRITE_COOKIE = 'last_write'
+
+def read_pool(request: Request) -> Pool:
+    # Route reads to the replica unless it is lagging or this client wrote recently
+    if not app.state.replica_healthy:
+        return app.state.pool
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, ''))
+    except ValueError:
+        last_write = None
+    if last_write is not None and time.time() - last_write < READ_YOUR_WRITES_WINDOW:
+        return app.state.pool
+    return app.state.read_pool
+
+@app.middleware("http")
+async def track_client_writes(request: Request, call_next):
+    response = await call_next(request)
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        response.set_cookie(
+            LAST_WRITE_COOKIE, str(time.time()),
+            max_age=max(1, math.ceil(READ_YOUR_WRITES_WINDOW)),
+            httponly=True, samesite='lax'
+        )
+    return response
+
+# Initialize database pools on startup
 @app.on_event("startup")
 async def startup():
     app.state.pool = await get_db_pool()
+    app.state.replica_healthy = False
+    app.state.replica_monitor = None
+    if os.getenv('DB_READ_HOST'):
+        # Reads stay on the primary until the monitor finds the replica healthy
+        app.state.read_pool = None
+        try:
+            app.state.read_pool = await get_db_pool('DB_READ')
+        except Exception as e:
+            print(f"Error connecting to read replica: {str(e)}")
+        app.state.replica_monitor = asyncio.create_task(monitor_replica_lag())
+    else:
+        # No replica configured: reads share the primary pool
+        app.state.read_pool = app.state.pool
+        app.state.replica_healthy = True
+    app.state.reservation_sweeper = asyncio.create_task(sweep_expired_reservations())
+    app.state.notification_wakeup = asyncio.Event()
+    app.state.http_client = httpx.AsyncClient(
+        timeout=NOTIFICATION_TIMEOUT,
+        limits=httpx.Limits(max_connections=NOTIFICATION_CONCURRENCY)
+    )
+    app.state.notification_dispatcher = None
+    app.state.notification_purger = None
+    if NOTIFICATION_WEBHOOK_URL:
+        app.state.notification_dispatcher = asyncio.create_task(run_notification_dispatcher(
+            app.state.pool, app.state.http_client, NOTIFICATION_WEBHOOK_URL,
+            app.state.notification_wakeup
+        ))
+        app.state.notification_purger = asyncio.create_task(purge_delivered_notifications())
 
 @app.on_event("shutdown")
 async def shutdown():
+    # Stop background tasks and wait for them before closing what they use,
+    # so an in-flight delivery doesn't hit a closed HTTP client
+    tasks = [
+        task for task in (
+            app.state.notification_dispatcher,
+            app.state.notification_purger,
+            app.state.reservation_sweeper,
+            app.state.replica_monitor
+        ) if task
+    ]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await app.state.http_client.aclose()
+    if app.state.read_pool is not None and app.state.read_pool is not app.state.pool:
+        await app.state.read_pool.close()
     await app.state.pool.close()
 
 # Pydantic models
@@ -82,9 +224,10 @@ class Prize(BaseModel):
     id: str
     name: str
     description: Optional[str]
-    stars_cost: int
+    stars_cost: int = Field(ge=0)
     image_url: Optional[str]
     available: bool = True
+    stock: Optional[int] = Field(None, ge=0)  # None means unlimited
 
 class QuestUpdate(BaseModel):
     title: Optional[str] = None
@@ -115,12 +258,19 @@ class PrizeRedemption(BaseModel):
     seeker_id: str
     redeemed_at: str
     certificate_id: str
-    stars_cost: int
+    stars_cost: Optional[int] = None  # Ignored; the prize's own cost is charged
+    reservation_id: Optional[str] = None
+
+class PrizeReservationRequest(BaseModel):
+    seeker_id: str
+
+class PrizeRestockRequest(BaseModel):
+    stock: Optional[int] = Field(None, ge=0)  # None makes the prize unlimited
 
 # Initial routes
 @app.get("/api/seekers")
-async def get_seekers():
-    async with app.state.pool.acquire() as conn:
+async def get_seekers(request: Request):
+    async with read_pool(request).acquire() as conn:
         rows = await conn.fetch('SELECT * FROM seekers')
         # Convert rows to use frontend property name
         return [{
@@ -146,8 +296,8 @@ async def create_seeker(seeker: Seeker):
 
 # Quest routes
 @app.get("/api/quests")
-async def get_quests():
-    async with app.state.pool.acquire() as conn:
+async def get_quests(request: Request):
+    async with read_pool(request).acquire() as conn:
         try:
             rows = await conn.fetch('SELECT * FROM quests')
             quests = [dict(row) for row in rows]
@@ -325,8 +475,8 @@ async def update_quest(quest_id: str, quest_update: QuestUpdate):
 
 # Quest suggestion endpoints
 @app.get("/api/quest-suggestions")
-async def get_quest_suggestions():
-    async with app.state.pool.acquire() as conn:
+async def get_quest_suggestions(request: Request):
+    async with read_pool(request).acquire() as conn:
         rows = await conn.fetch('SELECT * FROM quest_suggestions')
         return [dict(row) for row in rows]
 
@@ -337,13 +487,23 @@ async def create_quest_suggestion(suggestion: QuestSuggestion):
             # Parse the created_at string into a datetime object
             created_at = datetime.fromisoformat(suggestion.created_at.replace('Z', '+00:00')) if suggestion.created_at else datetime.utcnow()
             
-            await conn.execute('''
-                INSERT INTO quest_suggestions 
-                (id, title, description, suggested_by, status, created_at, desired_reward, duration)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-            ''', suggestion.id, suggestion.title, suggestion.description, 
-                suggestion.suggested_by, suggestion.status, created_at,  # Use the parsed datetime
-                suggestion.desired_reward, suggestion.duration)
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO quest_suggestions 
+                    (id, title, description, suggested_by, status, created_at, desired_reward, duration)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                ''', suggestion.id, suggestion.title, suggestion.description, 
+                    suggestion.suggested_by, suggestion.status, created_at,  # Use the parsed datetime
+                    suggestion.desired_reward, suggestion.duration)
+
+                await enqueue_notification(conn, 'quest_suggestion.created', {
+                    "suggestion_id": suggestion.id,
+                    "title": suggestion.title,
+                    "suggested_by": suggestion.suggested_by,
+                    "desired_reward": suggestion.desired_reward,
+                    "created_at": created_at.isoformat()
+                })
+            wake_notification_dispatcher()
             
             return {
                 **suggestion.dict(),
@@ -403,40 +563,405 @@ async def reject_quest_suggestion(suggestion_id: str):
             print(f"Error rejecting suggestion: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
+# Prize stock helpers
+# Picks a random shard of the prize ($2) that still has stock. SKIP LOCKED
+# lets concurrent redemptions spread over the other shards instead of queueing.
+STOCK_SHARD_CTE = '''
+    shard AS (
+        SELECT ps.prize_id, ps.shard
+        FROM prize_stock_shards ps
+        JOIN prizes p ON p.id = ps.prize_id
+        WHERE ps.prize_id = $2 AND ps.remaining > 0 AND p.available = true
+        ORDER BY random()
+        LIMIT 1
+        FOR UPDATE OF ps SKIP LOCKED
+    ),
+    taken AS (
+        UPDATE prize_stock_shards ps
+        SET remaining = ps.remaining - 1
+        FROM shard
+        WHERE ps.prize_id = shard.prize_id AND ps.shard = shard.shard
+        RETURNING ps.prize_id, ps.shard
+    )
+'''
+
+async def fetch_with_stock(conn, prize_id: str, query: str, *args, attempts: int = 20):
+    # If every shard with stock is locked at that moment, retry the pick
+    # rather than report sold out. Returns None only once the stock is gone.
+    for _ in range(attempts):
+        row = await conn.fetchrow(query, *args)
+        if row is not None:
+            return row
+        remaining = await conn.fetchval('''
+            SELECT SUM(ps.remaining)
+            FROM prize_stock_shards ps
+            JOIN prizes p ON p.id = ps.prize_id
+            WHERE ps.prize_id = $1 AND p.available = true
+        ''', prize_id)
+        if not remaining:
+            return None
+        await asyncio.sleep(random.uniform(0.005, 0.02))
+    # Stock is left but every shard stayed locked; the client should retry
+    raise HTTPException(status_code=503, detail="Prize is busy, please retry",
+                        headers={"Retry-After": "1"})
+
+async def set_prize_stock(conn, prize_id: str, stock: Optional[int]):
+    # Restocking sets the total quantity on offer. Units already held by
+    # reservations count against it and their holds move onto the new shards.
+    await conn.execute('DELETE FROM prize_stock_shards WHERE prize_id = $1', prize_id)
+    if stock is None:
+        return
+    shards = max(1, min(PRIZE_STOCK_SHARDS, stock))
+
+    # Holds beyond the new quantity are dropped, latest first
+    await conn.execute('''
+        DELETE FROM prize_reservations
+        WHERE id IN (
+            SELECT id FROM prize_reservations
+            WHERE prize_id = $1
+            ORDER BY expires_at
+            OFFSET $2
+        )
+    ''', prize_id, stock)
+    held = await conn.fetchval('''
+        WITH moved AS (
+            UPDATE prize_reservations
+            SET shard = shard % $2
+            WHERE prize_id = $1
+            RETURNING id
+        )
+        SELECT COUNT(*) FROM moved
+    ''', prize_id, shards)
+
+    await conn.execute('''
+        INSERT INTO prize_stock_shards (prize_id, shard, remaining)
+        SELECT $1, n, $2 / $3 + CASE WHEN n < $2 % $3 THEN 1 ELSE 0 END
+        FROM generate_series(0, $3 - 1) AS n
+    ''', prize_id, stock - held, shards)
+
+async def charge_seeker_for_prize(conn, prize_id: str, seeker_id: str) -> int:
+    # Charges the prize's own cost, never a client-supplied one
+    stars_cost = await conn.fetchval(
+        'SELECT stars_cost FROM prizes WHERE id = $1', prize_id
+    )
+    if stars_cost is None:
+        raise HTTPException(status_code=404, detail="Prize not found")
+
+    result = await conn.execute('''
+        UPDATE seekers 
+        SET stars = stars - $1 
+        WHERE id = $2 AND stars >= $1
+    ''', stars_cost, seeker_id)
+
+    if result == 'UPDATE 0':
+        raise HTTPException(status_code=400, detail="Insufficient stars")
+    return stars_cost
+
+async def insert_redemption(conn, redemption_id: str, prize_id: str, seeker_id: str,
+                            redeemed_at: datetime, certificate_id: str, stars_cost: int,
+                            reservation_id: Optional[str] = None) -> bool:
+    # Takes one unit of stock and records the redemption in a single
+    # statement. Returns False if the prize is sold out or unavailable.
+    if reservation_id:
+        row = await conn.fetchrow('''
+            WITH held AS (
+                DELETE FROM prize_reservations
+                WHERE id = $7 AND prize_id = $2 AND seeker_id = $3
+                AND expires_at > now()
+                RETURNING prize_id
+            )
+            INSERT INTO prize_redemptions
+            (id, prize_id, seeker_id, redeemed_at, certificate_id, stars_cost)
+            SELECT $1, held.prize_id, $3, $4, $5, $6 FROM held
+            RETURNING id
+        ''', redemption_id, prize_id, seeker_id, redeemed_at,
+            certificate_id, stars_cost, reservation_id)
+        return row is not None
+
+    row = await fetch_with_stock(conn, prize_id, '''
+        WITH prize AS (
+            SELECT id, stock FROM prizes WHERE id = $2 AND available = true
+        ),''' + STOCK_SHARD_CTE + '''
+        INSERT INTO prize_redemptions
+        (id, prize_id, seeker_id, redeemed_at, certificate_id, stars_cost)
+        SELECT $1, prize.id, $3, $4, $5, $6 FROM prize
+        WHERE prize.stock IS NULL OR EXISTS (SELECT 1 FROM taken)
+        RETURNING id
+    ''', redemption_id, prize_id, seeker_id, redeemed_at, certificate_id, stars_cost)
+    return row is not None
+
+async def release_reservations(conn, condition: str, *args) -> int:
+    # Deletes matching reservations and returns their units to the shards
+    result = await conn.fetchval(f'''
+        WITH released AS (
+            DELETE FROM prize_reservations
+            WHERE id IN (
+                SELECT id FROM prize_reservations
+                WHERE {condition}
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING prize_id, shard
+        ),
+        restocked AS (
+            UPDATE prize_stock_shards ps
+            SET remaining = ps.remaining + r.units
+            FROM (
+                SELECT prize_id, shard, COUNT(*) AS units
+                FROM released
+                GROUP BY prize_id, shard
+            ) r
+            WHERE ps.prize_id = r.prize_id AND ps.shard = r.shard
+        )
+        SELECT COUNT(*) FROM released
+    ''', *args)
+    return result or 0
+
+async def sweep_expired_reservations():
+    while True:
+        try:
+            async with app.state.pool.acquire() as conn:
+                await release_reservations(conn, 'expires_at <= now()')
+        except Exception as e:
+            print(f"Error releasing expired reservations: {str(e)}")
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+
+# Notification outbox
+# Handlers write notifications into notification_outbox inside the same
+# transaction as the state change; a background dispatcher delivers them.
+async def enqueue_notification(conn, event_type: str, payload: dict):
+    # Without a webhook there is no dispatcher to drain the outbox
+    if not NOTIFICATION_WEBHOOK_URL:
+        return
+    await conn.execute('''
+        INSERT INTO notification_outbox (event_type, payload)
+        VALUES ($1, $2::jsonb)
+    ''', event_type, json.dumps(payload, default=str))
+
+def wake_notification_dispatcher():
+    # Call after the enqueuing transaction commits so delivery starts at once
+    app.state.notification_wakeup.set()
+
+def notification_backoff(attempts: int) -> float:
+    # Exponential backoff with full jitter
+    delay = min(NOTIFICATION_BACKOFF_MAX, NOTIFICATION_BACKOFF_BASE ** attempts)
+    return random.uniform(0, delay)
+
+async def deliver_notification(client: httpx.AsyncClient, url: str, row) -> Optional[str]:
+    # Returns None on success, otherwise the error to record
+    try:
+        response = await client.post(url, json={
+            "id": row['id'],
+            "event": row['event_type'],
+            "payload": json.loads(row['payload']),
+            "created_at": row['created_at'].isoformat()
+        }, headers={"Idempotency-Key": f"notification-{row['id']}"})
+        if response.is_success:
+            return None
+        return f"HTTP {response.status_code}"
+    except Exception as e:
+        # Any failure, not just transport errors, must be recorded for the row
+        return f"{type(e).__name__}: {str(e)}"
+
+async def drain_notification_outbox(pool: Pool, client: httpx.AsyncClient, url: str) -> int:
+    # Claims one batch of due notifications, delivers them concurrently and
+    # records the outcome. Returns the number of notifications claimed.
+    async with pool.acquire() as conn:
+        # Push next_attempt_at out as a lease, long enough for the whole batch
+        # to time out, so other dispatchers skip these rows meanwhile
+        rows = await conn.fetch('''
+            UPDATE notification_outbox
+            SET next_attempt_at = now() + make_interval(secs => $2)
+            WHERE id IN (
+                SELECT id FROM notification_outbox
+                WHERE status = 'pending' AND next_attempt_at <= now()
+                ORDER BY next_attempt_at
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, event_type, payload, attempts, created_at, next_attempt_at
+        ''', NOTIFICATION_BATCH_SIZE,
+            NOTIFICATION_TIMEOUT * (NOTIFICATION_BATCH_SIZE // NOTIFICATION_CONCURRENCY + 2))
+    if not rows:
+        return 0
+
+    semaphore = asyncio.Semaphore(NOTIFICATION_CONCURRENCY)
+
+    async def deliver(row):
+        async with semaphore:
+            return await deliver_notification(client, url, row)
+
+    errors = await asyncio.gather(*(deliver(row) for row in rows))
+
+    # Outcomes only apply while our lease still holds; if the batch outlived
+    # it and another dispatcher re-claimed a row, that attempt owns the row
+    delivered = [
+        (row['id'], row['next_attempt_at'])
+        for row, error in zip(rows, errors) if error is None
+    ]
+    failed = []
+    for row, error in zip(rows, errors):
+        if error is None:
+            continue
+        attempts = row['attempts'] + 1
+        status = 'dead' if attempts >= NOTIFICATION_MAX_ATTEMPTS else 'pending'
+        failed.append((row['id'], row['next_attempt_at'], status, attempts,
+                       notification_backoff(attempts), error))
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if delivered:
+                await conn.executemany('''
+                    UPDATE notification_outbox
+                    SET status = 'delivered', delivered_at = now(), last_error = NULL
+                    WHERE id = $1 AND next_attempt_at = $2
+                ''', delivered)
+            if failed:
+                await conn.executemany('''
+                    UPDATE notification_outbox
+                    SET status = $3, attempts = $4,
+                        next_attempt_at = now() + make_interval(secs => $5),
+                        last_error = $6
+                    WHERE id = $1 AND next_attempt_at = $2
+                ''', failed)
+    for notification_id, _, status, attempts, _, error in failed:
+        if status == 'dead':
+            print(f"Notification {notification_id} dead-lettered after {attempts} attempts: {error}")
+    return len(rows)
+
+async def run_notification_dispatcher(pool: Pool, client: httpx.AsyncClient, url: str,
+                                      wakeup: asyncio.Event):
+    while True:
+        # Clear before draining so a wakeup that arrives mid-drain is kept
+        wakeup.clear()
+        try:
+            claimed = await drain_notification_outbox(pool, client, url)
+        except Exception as e:
+            print(f"Error dispatching notifications: {str(e)}")
+            claimed = 0
+        # A full batch means more may be waiting; otherwise idle until woken
+        if claimed < NOTIFICATION_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(wakeup.wait(), NOTIFICATION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+async def purge_delivered_notifications():
+    while True:
+        try:
+            async with app.state.pool.acquire() as conn:
+                await conn.execute('''
+                    DELETE FROM notification_outbox
+                    WHERE status = 'delivered'
+                    AND delivered_at < now() - make_interval(secs => $1)
+                ''', NOTIFICATION_RETENTION)
+        except Exception as e:
+            print(f"Error purging delivered notifications: {str(e)}")
+        await asyncio.sleep(NOTIFICATION_PURGE_INTERVAL)
+
 # Prize management endpoints
 @app.get("/api/prizes")
-async def get_prizes():
-    async with app.state.pool.acquire() as conn:
-        rows = await conn.fetch('SELECT * FROM prizes WHERE available = true')
+async def get_prizes(request: Request):
+    async with read_pool(request).acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT p.*, (
+                SELECT SUM(remaining)
+                FROM prize_stock_shards ps
+                WHERE ps.prize_id = p.id
+            ) AS remaining_stock
+            FROM prizes p
+            WHERE p.available = true
+        ''')
         return [dict(row) for row in rows]
 
+@app.post("/api/prizes/{prize_id}/reservations")
+async def reserve_prize(prize_id: str, request: PrizeReservationRequest):
+    async with app.state.pool.acquire() as conn:
+        try:
+            prize = await conn.fetchrow(
+                'SELECT stock, stars_cost FROM prizes WHERE id = $1 AND available = true',
+                prize_id
+            )
+            if not prize:
+                raise HTTPException(status_code=404, detail="Prize not found")
+            if prize['stock'] is None:
+                raise HTTPException(status_code=400, detail="Prize does not have limited stock")
+
+            # Holds are not paid for up front, but only a seeker who can
+            # currently afford the prize may take one
+            stars = await conn.fetchval(
+                'SELECT stars FROM seekers WHERE id = $1', request.seeker_id
+            )
+            if stars is None:
+                raise HTTPException(status_code=404, detail="Seeker not found")
+            if stars < prize['stars_cost']:
+                raise HTTPException(status_code=400, detail="Insufficient stars")
+
+            # One hold per seeker and prize; an expired one is returned first
+            await release_reservations(
+                conn, 'prize_id = $1 AND seeker_id = $2 AND expires_at <= now()',
+                prize_id, request.seeker_id
+            )
+
+            reservation_id = str(uuid.uuid4())
+            reservation = await fetch_with_stock(conn, prize_id, '''
+                WITH''' + STOCK_SHARD_CTE + '''
+                INSERT INTO prize_reservations (id, prize_id, seeker_id, shard, expires_at)
+                SELECT $1, taken.prize_id, $3, taken.shard, now() + make_interval(secs => $4)
+                FROM taken
+                RETURNING id, expires_at
+            ''', reservation_id, prize_id, request.seeker_id, RESERVATION_TTL)
+
+            if not reservation:
+                raise HTTPException(status_code=409, detail="Prize is out of stock")
+
+            return {
+                "reservation_id": reservation['id'],
+                "prize_id": prize_id,
+                "expires_at": reservation['expires_at'].isoformat()
+            }
+        except HTTPException:
+            raise
+        except asyncpg.UniqueViolationError:
+            raise HTTPException(status_code=409, detail="Seeker already holds this prize")
+        except Exception as e:
+            print(f"Error reserving prize: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/prize-reservations/{reservation_id}")
+async def release_prize_reservation(reservation_id: str):
+    async with app.state.pool.acquire() as conn:
+        try:
+            released = await release_reservations(conn, 'id = $1', reservation_id)
+            if not released:
+                raise HTTPException(status_code=404, detail="Reservation not found")
+            return {"message": "Reservation released"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error releasing reservation: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/prizes/redeem")
-async def redeem_prize(prize_id: str, seeker_id: str, stars_cost: int):
+async def redeem_prize(prize_id: str, seeker_id: str,
+                       reservation_id: Optional[str] = None):
     async with app.state.pool.acquire() as conn:
         try:
             async with conn.transaction():
                 # Update seeker's stars
-                result = await conn.execute('''
-                    UPDATE seekers 
-                    SET stars = stars - $1 
-                    WHERE id = $2 AND stars >= $1
-                ''', stars_cost, seeker_id)
-                
-                if result == 'UPDATE 0':
-                    raise HTTPException(status_code=400, detail="Insufficient stars")
+                stars_cost = await charge_seeker_for_prize(conn, prize_id, seeker_id)
 
-                # Create redemption record
+                # Take stock and create redemption record
                 redemption_id = str(uuid.uuid4())
                 certificate_id = str(uuid.uuid4())
-                now = datetime.utcnow().isoformat()
-                
-                await conn.execute('''
-                    INSERT INTO prize_redemptions 
-                    (id, prize_id, seeker_id, redeemed_at, certificate_id, stars_cost)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                ''', redemption_id, prize_id, seeker_id, now, certificate_id, stars_cost)
+                now = datetime.utcnow()
+
+                if not await insert_redemption(conn, redemption_id, prize_id, seeker_id,
+                                               now, certificate_id, stars_cost, reservation_id):
+                    raise HTTPException(status_code=409, detail="Prize is out of stock or reservation expired")
 
                 return {"certificate_id": certificate_id}
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e)) 
 
@@ -445,12 +970,14 @@ async def redeem_prize(prize_id: str, seeker_id: str, stars_cost: int):
 async def create_prize(prize: Prize):
     async with app.state.pool.acquire() as conn:
         try:
-            await conn.execute('''
-                INSERT INTO prizes 
-                (id, name, description, stars_cost, image_url, available) 
-                VALUES ($1, $2, $3, $4, $5, $6)
-            ''', prize.id, prize.name, prize.description, 
-                prize.stars_cost, prize.image_url, prize.available)
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO prizes 
+                    (id, name, description, stars_cost, image_url, available, stock) 
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
+                ''', prize.id, prize.name, prize.description, 
+                    prize.stars_cost, prize.image_url, prize.available, prize.stock)
+                await set_prize_stock(conn, prize.id, prize.stock)
             return prize
         except Exception as e:
             print(f"Error creating prize: {str(e)}")
@@ -460,17 +987,54 @@ async def create_prize(prize: Prize):
 async def update_prize(prize_id: str, prize: Prize):
     async with app.state.pool.acquire() as conn:
         try:
-            await conn.execute('''
+            # Stock is left alone here; restocking has its own endpoint
+            updated_prize = await conn.fetchrow('''
                 UPDATE prizes 
                 SET name = $1, description = $2, stars_cost = $3, 
                     image_url = $4, available = $5
                 WHERE id = $6
+                RETURNING *, (
+                    SELECT SUM(remaining)
+                    FROM prize_stock_shards ps
+                    WHERE ps.prize_id = prizes.id
+                ) AS remaining_stock
             ''', prize.name, prize.description, prize.stars_cost,
                 prize.image_url, prize.available, prize_id)
-            return {**prize.dict(), "id": prize_id}
+            if not updated_prize:
+                raise HTTPException(status_code=404, detail="Prize not found")
+            return dict(updated_prize)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/prizes/{prize_id}/restock")
+async def restock_prize(prize_id: str, request: PrizeRestockRequest):
+    async with app.state.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                result = await conn.execute(
+                    'UPDATE prizes SET stock = $1 WHERE id = $2',
+                    request.stock, prize_id
+                )
+                if result == 'UPDATE 0':
+                    raise HTTPException(status_code=404, detail="Prize not found")
+                await set_prize_stock(conn, prize_id, request.stock)
+
+                remaining_stock = await conn.fetchval('''
+                    SELECT SUM(remaining) FROM prize_stock_shards WHERE prize_id = $1
+                ''', prize_id)
+            return {
+                "id": prize_id,
+                "stock": request.stock,
+                "remaining_stock": remaining_stock
+            }
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error restocking prize: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
 @app.delete("/api/prizes/{prize_id}")
 async def delete_prize(prize_id: str):
     async with app.state.pool.acquire() as conn:
@@ -494,8 +1058,8 @@ async def delete_prize(prize_id: str):
 
 # Quest history and completion endpoints
 @app.get("/api/quests/history")
-async def get_quest_history():
-    async with app.state.pool.acquire() as conn:
+async def get_quest_history(request: Request):
+    async with read_pool(request).acquire() as conn:
         try:
             rows = await conn.fetch('''
                 SELECT q.*, s.name as seeker_name 
@@ -509,8 +1073,8 @@ async def get_quest_history():
             raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/seekers/{seeker_id}/quests")
-async def get_seeker_quests(seeker_id: str):
-    async with app.state.pool.acquire() as conn:
+async def get_seeker_quests(seeker_id: str, request: Request):
+    async with read_pool(request).acquire() as conn:
         try:
             rows = await conn.fetch('''
                 SELECT * FROM quests 
@@ -537,16 +1101,28 @@ async def complete_quest(quest_id: str, request: QuestCompleteRequest):
                 )
 
             now = datetime.utcnow()
-            await conn.execute('''
-                UPDATE quests 
-                SET status = 'pending', completed_at = $1 
-                WHERE id = $2 AND assigned_to = $3
-            ''', now, quest_id, request.seeker_id)
+            async with conn.transaction():
+                await conn.execute('''
+                    UPDATE quests 
+                    SET status = 'pending', completed_at = $1 
+                    WHERE id = $2 AND assigned_to = $3
+                ''', now, quest_id, request.seeker_id)
+
+                await enqueue_notification(conn, 'quest.pending', {
+                    "quest_id": quest_id,
+                    "title": quest['title'],
+                    "seeker_id": request.seeker_id,
+                    "reward": quest['reward'],
+                    "completed_at": now.isoformat()
+                })
+            wake_notification_dispatcher()
             
             return {
                 "status": "pending",
                 "completed_at": now.isoformat()
             }
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Error completing quest: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
@@ -599,8 +1175,8 @@ async def delete_quest(quest_id: str):
             raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/seekers/{seeker_id}")
-async def get_seeker(seeker_id: str):
-    async with app.state.pool.acquire() as conn:
+async def get_seeker(seeker_id: str, request: Request):
+    async with read_pool(request).acquire() as conn:
         try:
             # Get seeker's base info
             seeker = await conn.fetchrow(
@@ -644,33 +1220,32 @@ async def create_prize_redemption(redemption: PrizeRedemption):
                 # Convert ISO string to datetime object
                 redeemed_at = datetime.fromisoformat(redemption.redeemed_at.replace('Z', '+00:00'))
                 
-                # Insert the redemption
-                await conn.execute('''
-                    INSERT INTO prize_redemptions 
-                    (id, prize_id, seeker_id, redeemed_at, certificate_id, stars_cost)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                ''', redemption.id, redemption.prize_id, redemption.seeker_id,
-                    redeemed_at,
-                    redemption.certificate_id, redemption.stars_cost)
-
-                # Update seeker's stars in the seekers table
-                await conn.execute('''
-                    UPDATE seekers 
-                    SET stars = stars - $1 
-                    WHERE id = $2
-                ''', redemption.stars_cost, redemption.seeker_id)
+                # Update seeker's stars in the seekers table, refusing to go negative
+                stars_cost = await charge_seeker_for_prize(
+                    conn, redemption.prize_id, redemption.seeker_id
+                )
+
+                # Take stock and insert the redemption
+                if not await insert_redemption(conn, redemption.id, redemption.prize_id,
+                                               redemption.seeker_id, redeemed_at,
+                                               redemption.certificate_id, stars_cost,
+                                               redemption.reservation_id):
+                    raise HTTPException(status_code=409, detail="Prize is out of stock or reservation expired")
 
                 return {
                     **redemption.dict(),
+                    "stars_cost": stars_cost,
                     "redeemed_at": redeemed_at.isoformat()
                 }
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"Error creating prize redemption: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/seekers/{seeker_id}/redemptions")
-async def get_seeker_redemptions(seeker_id: str):
-    async with app.state.pool.acquire() as conn:
+async def get_seeker_redemptions(seeker_id: str, request: Request):
+    async with read_pool(request).acquire() as conn:
         try:
             # Add debug logging
             print(f"Fetching redemptions for seeker: {seeker_id}")
@@ -699,8 +1274,8 @@ async def get_seeker_redemptions(seeker_id: str):
             raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/prize-redemptions")
-async def get_all_redemptions():
-    async with app.state.pool.acquire() as conn:
+async def get_all_redemptions(request: Request):
+    async with read_pool(request).acquire() as conn:
         try:
             rows = await conn.fetch('''
                 SELECT 
@@ -720,3 +1295,37 @@ async def get_all_redemptions():
             print(f"Error fetching redemptions: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
+# Notification dead letters
+@app.get("/api/notifications/dead-letters")
+async def get_dead_letter_notifications(request: Request):
+    async with read_pool(request).acquire() as conn:
+        try:
+            rows = await conn.fetch('''
+                SELECT id, event_type, payload, attempts, last_error, created_at
+                FROM notification_outbox
+                WHERE status = 'dead'
+                ORDER BY created_at DESC
+            ''')
+            return [{**dict(row), 'payload': json.loads(row['payload'])} for row in rows]
+        except Exception as e:
+            print(f"Error fetching dead-letter notifications: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/notifications/{notification_id}/retry")
+async def retry_notification(notification_id: int):
+    async with app.state.pool.acquire() as conn:
+        try:
+            result = await conn.execute('''
+                UPDATE notification_outbox
+                SET status = 'pending', attempts = 0, next_attempt_at = now()
+                WHERE id = $1 AND status = 'dead'
+            ''', notification_id)
+            if result == 'UPDATE 0':
+                raise HTTPException(status_code=404, detail="Dead-letter notification not found")
+            wake_notification_dispatcher()
+            return {"message": "Notification requeued"}
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Error retrying notification: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
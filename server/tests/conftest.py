@@ -0,0 +1,21 @@
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), '..', 'db', 'schema.postgres.sql')
+
+
+def temp_schema(*tables):
+    # Build tables (and their indexes) from the real schema as temp tables,
+    # so tests never touch real data. Needs a single-connection pool.
+    with open(SCHEMA_PATH) as f:
+        schema = f.read()
+    statements = []
+    for table in tables:
+        ddl = re.search(rf'CREATE TABLE {table} \(.*?\n\);', schema, re.S).group(0)
+        statements.append(ddl.replace('CREATE TABLE', 'CREATE TEMP TABLE'))
+        statements += re.findall(rf'CREATE (?:UNIQUE )?INDEX \w+ ON {table}\(.*?\);', schema)
+    return '\n'.join(statements)
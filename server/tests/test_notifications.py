@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+asyncpg = pytest.importorskip("asyncpg")
+httpx = pytest.importorskip("httpx")
+
+import main  # noqa: E402
+from conftest import TEST_DATABASE_URL, temp_schema  # noqa: E402
+
+WEBHOOK_URL = 'http://notifications.test/hook'
+
+pytestmark = pytest.mark.skipif(
+    not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set"
+)
+
+
+async def drain_once(respond, rows=1, during=None):
+    # One pooled connection, so the temp table is visible to the dispatcher.
+    # during(pool), if given, runs while each request is in flight.
+    pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=1)
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        if during:
+            await during(pool)
+        return respond(request)
+
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute(temp_schema('notification_outbox'))
+            for i in range(rows):
+                await main.enqueue_notification(conn, 'quest.pending', {"quest_id": f"q{i}"})
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            claimed = await main.drain_notification_outbox(pool, client, WEBHOOK_URL)
+
+        async with pool.acquire() as conn:
+            outbox = await conn.fetch('''
+                SELECT *, next_attempt_at > now() AS deferred
+                FROM notification_outbox ORDER BY id
+            ''')
+            await conn.execute('DROP TABLE notification_outbox')
+        return claimed, requests, outbox
+    finally:
+        await pool.close()
+
+
+def status(code):
+    return lambda request: httpx.Response(code)
+
+
+@pytest.fixture(autouse=True)
+def webhook_configured(monkeypatch):
+    monkeypatch.setattr(main, 'NOTIFICATION_WEBHOOK_URL', WEBHOOK_URL)
+
+
+def test_success_marks_delivered():
+    claimed, requests, outbox = asyncio.run(drain_once(status(200), rows=3))
+
+    assert claimed == 3
+    assert len(requests) == 3
+    assert requests[0].headers['Idempotency-Key'].startswith('notification-')
+    assert [row['status'] for row in outbox] == ['delivered'] * 3
+    assert all(row['delivered_at'] is not None for row in outbox)
+
+
+def test_server_error_schedules_retry(monkeypatch):
+    monkeypatch.setattr(main, 'notification_backoff', lambda attempts: 60)
+
+    claimed, _, outbox = asyncio.run(drain_once(status(503)))
+
+    assert claimed == 1
+    row = outbox[0]
+    assert row['status'] == 'pending'
+    assert row['attempts'] == 1
+    assert row['last_error'] == 'HTTP 503'
+    assert row['deferred']
+
+
+def test_max_attempts_dead_letters(monkeypatch):
+    monkeypatch.setattr(main, 'NOTIFICATION_MAX_ATTEMPTS', 1)
+
+    _, _, outbox = asyncio.run(drain_once(status(500)))
+
+    assert outbox[0]['status'] == 'dead'
+    assert outbox[0]['attempts'] == 1
+
+
+def test_unexpected_error_is_recorded(monkeypatch):
+    monkeypatch.setattr(main, 'NOTIFICATION_MAX_ATTEMPTS', 1)
+
+    def broken(request):
+        raise ValueError("stub exploded")
+
+    claimed, _, outbox = asyncio.run(drain_once(broken, rows=2))
+
+    assert claimed == 2
+    assert [row['status'] for row in outbox] == ['dead'] * 2
+    assert outbox[0]['last_error'] == 'ValueError: stub exploded'
+
+
+def test_outcome_ignored_after_lease_is_lost():
+    async def reclaim(pool):
+        # Another dispatcher takes the row over once our lease has expired
+        await pool.execute('''
+            UPDATE notification_outbox
+            SET next_attempt_at = next_attempt_at + interval '1 minute', attempts = 5
+        ''')
+
+    _, _, outbox = asyncio.run(drain_once(status(200), during=reclaim))
+
+    assert outbox[0]['status'] == 'pending'
+    assert outbox[0]['attempts'] == 5
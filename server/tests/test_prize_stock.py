@@ -0,0 +1,167 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+import pytest
+
+asyncpg = pytest.importorskip("asyncpg")
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException  # noqa: E402
+
+import main  # noqa: E402
+from conftest import TEST_DATABASE_URL, temp_schema  # noqa: E402
+
+pytestmark = pytest.mark.skipif(
+    not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set"
+)
+
+PRIZE_COST = 5
+
+
+def run(test, stock=3, stars=100, seekers=('s1',)):
+    # Runs test(pool) against temp prize tables. The pool has a single
+    # connection, shared with the handlers through app.state.pool
+    async def runner():
+        pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=1)
+        main.app.state.pool = pool
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute(temp_schema(
+                    'seekers', 'prizes', 'prize_stock_shards',
+                    'prize_reservations', 'prize_redemptions'
+                ))
+                for seeker_id in seekers:
+                    await conn.execute(
+                        "INSERT INTO seekers (id, name, pin, stars) VALUES ($1, $1, '0000', $2)",
+                        seeker_id, stars
+                    )
+            await main.create_prize(main.Prize(
+                id='p1', name='Movie night', description=None,
+                stars_cost=PRIZE_COST, image_url=None, stock=stock
+            ))
+            return await test(pool)
+        finally:
+            await pool.close()
+
+    return asyncio.run(runner())
+
+
+async def redeem(seeker_id='s1', reservation_id=None):
+    return await main.create_prize_redemption(main.PrizeRedemption(
+        id=str(uuid.uuid4()), prize_id='p1', seeker_id=seeker_id,
+        redeemed_at=datetime.utcnow().isoformat(),
+        certificate_id=str(uuid.uuid4()), reservation_id=reservation_id
+    ))
+
+
+async def reserve(seeker_id='s1'):
+    return await main.reserve_prize('p1', main.PrizeReservationRequest(seeker_id=seeker_id))
+
+
+async def remaining(db):
+    return await db.fetchval(
+        "SELECT COALESCE(SUM(remaining), 0) FROM prize_stock_shards WHERE prize_id = 'p1'"
+    )
+
+
+async def stars(db, seeker_id='s1'):
+    return await db.fetchval('SELECT stars FROM seekers WHERE id = $1', seeker_id)
+
+
+def test_redeem_until_sold_out():
+    async def test(db):
+        for _ in range(3):
+            await redeem()
+        with pytest.raises(HTTPException) as error:
+            await redeem()
+        assert error.value.status_code == 409
+        assert await remaining(db) == 0
+        # The failed redemption charged nothing
+        assert await stars(db) == 100 - 3 * PRIZE_COST
+        assert await db.fetchval('SELECT COUNT(*) FROM prize_redemptions') == 3
+
+    run(test)
+
+
+def test_insufficient_stars_leaves_balance_and_stock():
+    async def test(db):
+        with pytest.raises(HTTPException) as error:
+            await redeem()
+        assert error.value.status_code == 400
+        assert await stars(db) == PRIZE_COST - 1
+        assert await remaining(db) == 3
+
+    run(test, stars=PRIZE_COST - 1)
+
+
+def test_redeem_consumes_reservation():
+    async def test(db):
+        reservation = await reserve()
+        assert await remaining(db) == 2
+
+        await redeem(reservation_id=reservation['reservation_id'])
+        assert await remaining(db) == 2
+        assert await db.fetchval('SELECT COUNT(*) FROM prize_reservations') == 0
+
+    run(test)
+
+
+def test_one_active_hold_per_seeker():
+    async def test(db):
+        await reserve()
+        with pytest.raises(HTTPException) as error:
+            await reserve()
+        assert error.value.status_code == 409
+        assert await remaining(db) == 2
+
+    run(test)
+
+
+def test_expired_reservation_is_swept_back_into_stock():
+    async def test(db):
+        await reserve()
+        assert await remaining(db) == 2
+
+        await db.execute("UPDATE prize_reservations SET expires_at = now() - interval '1 second'")
+        async with db.acquire() as conn:
+            released = await main.release_reservations(conn, 'expires_at <= now()')
+
+        assert released == 1
+        assert await remaining(db) == 3
+
+    run(test)
+
+
+def test_restock_below_outstanding_holds():
+    async def test(db):
+        for seeker_id in ('s1', 's2', 's3'):
+            await reserve(seeker_id)
+        assert await remaining(db) == 1
+
+        # Only one of the three holds fits the new quantity
+        result = await main.restock_prize('p1', main.PrizeRestockRequest(stock=1))
+        assert result['remaining_stock'] == 0
+        assert await db.fetchval('SELECT COUNT(*) FROM prize_reservations') == 1
+        assert await db.fetchval('SELECT MAX(shard) FROM prize_reservations') == 0
+
+        # Releasing the kept hold restores exactly the restocked quantity
+        async with db.acquire() as conn:
+            await main.release_reservations(conn, "prize_id = 'p1'")
+        assert await remaining(db) == 1
+
+    run(test, stock=4, seekers=('s1', 's2', 's3'))
+
+
+def test_update_prize_does_not_restock():
+    async def test(db):
+        await redeem()
+        updated = await main.update_prize('p1', main.Prize(
+            id='p1', name='Movie night out', description=None,
+            stars_cost=PRIZE_COST, image_url=None, stock=3
+        ))
+        assert updated['name'] == 'Movie night out'
+        assert updated['remaining_stock'] == 2
+        assert await remaining(db) == 2
+
+    run(test)
@@ -37,7 +37,9 @@ export interface Prize {
   description: string;
   stars_cost: number;
   image_url?: string;
-  available: boolean
+  available: boolean;
+  stock?: number | null;
+  remaining_stock?: number | null;
 }
 
 export interface PrizeRedemption {